@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+'''
+Pick training / inference batch sizes for the current machine
+
+For each candidate batch size, a fresh child process builds the model, runs a few batches
+of train_on_batch (mode "train") or predict (mode "predict") on random data of the given
+input shape, and reports samples/s and its peak resident memory.  The fastest batch size
+whose peak memory stays under the cap is recorded in batch_size.json, keyed by host,
+core count, input shape and model config, where train_network.py / eval_network.py pick it up.
+
+Note that for training the batch size also changes the optimization, not just the speed.
+
+Usage:
+    python batch_autotune.py --mode train --input_shape 1,96,173 --nb_classes 10
+    python batch_autotune.py --mode predict --memory_cap_mb 2000
+'''
+import numpy as np
+import argparse
+import json
+import hashlib
+import multiprocessing
+import socket
+import sys
+import time
+import os
+from os.path import isfile
+from model_config import load_model_config    # not model_builder: keras must not be loaded before forking
+
+record_filepath = "batch_size.json"
+
+
+def machine_key(input_shape, config_path="model_config.json"):
+    # the config as build_model sees it, so formatting or defaults spelled out don't change the key
+    config = json.dumps(load_model_config(config_path), sort_keys=True)
+    return '{}|{}cpu|{}|{}'.format(socket.gethostname(), multiprocessing.cpu_count(),
+                                   'x'.join(str(d) for d in input_shape),
+                                   hashlib.md5(config.encode('utf-8')).hexdigest()[0:8])
+
+# the split whose first file sets the clip shape: get_sample_dimensions in train_network.py / eval_network.py
+sample_paths = {"train": "Preproc/Preproc_Validation/", "predict": "Preproc/Preproc_Test/"}
+
+def sample_shape(mode):
+    # same lookup as get_sample_dimensions, so the recorded key matches the one used at load time;
+    # reimplemented here because importing train_network would load keras before forking
+    path = sample_paths[mode]
+    classname = os.listdir(path)[0]
+    return np.load(path + classname + '/' + os.listdir(path+classname)[0]).shape[1:]
+
+def load_batch_size(mode, input_shape, default):   # recorded choice for this machine, else default
+    if not isfile(record_filepath):
+        return default
+    with open(record_filepath) as f:
+        records = json.load(f)
+    record = records.get(machine_key(input_shape), {}).get(mode)
+    if record is None:
+        return default
+    print("Using autotuned",mode,"batch_size =",record["batch_size"])
+    return record["batch_size"]
+
+def save_batch_size(mode, input_shape, result):
+    records = {}
+    if isfile(record_filepath):
+        with open(record_filepath) as f:
+            records = json.load(f)
+    records.setdefault(machine_key(input_shape), {})[mode] = result
+    with open(record_filepath, 'w') as f:
+        json.dump(records, f, indent=4, sort_keys=True)
+
+
+def peak_memory_mb():
+    import resource    # Unix only; imported here so load_batch_size still works elsewhere
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss / (1024.0 * 1024.0)   # bytes on macOS
+    return maxrss / 1024.0                  # kilobytes on Linux
+
+def measure(mode, batch_size, input_shape, nb_classes, n_batches, result_queue):
+    # runs in its own process, so keras starts fresh and ru_maxrss is this candidate's peak
+    from model_builder import build_model
+    model = build_model(np.zeros((1,)+tuple(input_shape)), None, nb_classes)
+    model.compile(loss='categorical_crossentropy',
+                  optimizer='adadelta',
+                  metrics=['accuracy'])
+    X = np.random.rand(*((batch_size,)+tuple(input_shape))).astype(np.float32)
+    Y = np.eye(nb_classes)[np.random.randint(nb_classes, size=batch_size)]
+
+    def run_batch():
+        if (mode == 'train'):
+            model.train_on_batch(X, Y)
+        else:
+            model.predict(X, batch_size=batch_size)
+
+    run_batch()    # warm-up: graph/function compilation
+    start = time.time()
+    for i in range(n_batches):
+        run_batch()
+    elapsed = time.time() - start
+    result_queue.put((batch_size * n_batches / elapsed, peak_memory_mb()))
+
+def autotune(mode, input_shape, nb_classes, candidates, memory_cap_mb, n_batches=10):
+    results = []
+    print('{:>10s} {:>12s} {:>10s}'.format("batch_size","samples/s","peak MB"))
+    for batch_size in candidates:
+        result_queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=measure, args=(mode, batch_size, input_shape, nb_classes, n_batches, result_queue))
+        p.start()
+        p.join()
+        if (p.exitcode != 0):    # e.g. killed for running out of memory
+            print('{:10d} {:>12s} {:>10s}'.format(batch_size, "failed", "-"))
+            break
+        rate, peak_mb = result_queue.get()
+        print('{:10d} {:12.1f} {:10.0f}'.format(batch_size, rate, peak_mb))
+        if (peak_mb > memory_cap_mb):
+            break    # bigger batches only need more memory
+        results.append({"batch_size": batch_size, "samples_per_s": rate, "peak_mb": peak_mb})
+    if not results:
+        return None
+    return max(results, key=lambda r: r["samples_per_s"])
+
+def total_memory_mb():
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024.0 * 1024.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the fastest batch size under a memory cap on this machine")
+    parser.add_argument('--mode', choices=['train', 'predict'], default='train')
+    parser.add_argument('--input_shape', default=None, help='e.g. 1,96,173 (default: the shape train_network/eval_network will use)')
+    parser.add_argument('--nb_classes', type=int, default=None)
+    parser.add_argument('--candidates', default='1,2,4,8,16,32,64,128,256,512')
+    parser.add_argument('--memory_cap_mb', type=float, default=None, help='default: half of physical memory')
+    parser.add_argument('--batches', type=int, default=10, help='timed batches per candidate')
+    args = parser.parse_args()
+
+    if (args.input_shape is not None):
+        input_shape = tuple(int(d) for d in args.input_shape.split(','))
+    else:
+        input_shape = sample_shape(args.mode)
+    nb_classes = args.nb_classes
+    if nb_classes is None:
+        nb_classes = len(os.listdir("Preproc/Preproc_Train/"))
+    memory_cap_mb = args.memory_cap_mb
+    if memory_cap_mb is None:
+        memory_cap_mb = total_memory_mb() / 2
+
+    best = autotune(args.mode, input_shape, nb_classes, [int(b) for b in args.candidates.split(',')],
+                    memory_cap_mb, n_batches=args.batches)
+    if best is None:
+        print("No candidate fits under",memory_cap_mb,"MB")
+    else:
+        print("Best",args.mode,"batch_size =",best["batch_size"],"(",best["samples_per_s"],"samples/s )")
+        save_batch_size(args.mode, input_shape, best)
@@ -0,0 +1,231 @@
+from __future__ import print_function
+
+'''
+Clip embeddings and a nearest-neighbour index over them
+
+The output of the Dense(128) layer (after its relu) is used as the embedding of a clip.
+Embeddings for a whole Preproc/ split are extracted in batches into a float16 .npy file,
+with the clip paths alongside in <file>.paths.txt.
+
+The index is an IVF ("inverted file") index: k-means centroids split the embeddings into
+n_lists buckets, and a query only scans the n_probe buckets whose centroids are closest,
+instead of every clip.  Similarity is cosine similarity.
+
+Usage:
+    python embeddings.py extract --split Preproc/Preproc_Test/ --out emb_test.npy
+    python embeddings.py index --embeddings emb_test.npy --out index_test.npz --lists 256
+    python embeddings.py query --index index_test.npz --clip Preproc/Preproc_Test/dog/bark1.wav.npy -k 10
+    python embeddings.py dedup --index index_test.npz --threshold 0.99
+    python embeddings.py bench --index index_test.npz --embeddings emb_test.npy --probes 1,4,16
+'''
+import numpy as np
+import argparse
+import time
+import os
+from sklearn.cluster import MiniBatchKMeans
+from preproc_files import list_split, load_melgrams
+
+
+def embedding_model(model, layer_name=None):
+    from keras.models import Model
+    from keras.layers import Dense
+    if layer_name is not None:
+        layer = model.get_layer(layer_name)
+    else:
+        idx = [i for i, l in enumerate(model.layers) if isinstance(l, Dense)][0]
+        layer = model.layers[idx+1]    # the activation that follows the first Dense layer
+    return Model(inputs=model.input, outputs=layer.output)
+
+def extract_embeddings(path, outfile, checkpoint_filepath='weights1.hdf5', batch_size=128, dtype=np.float16):
+    from train_network import get_class_names, get_sample_dimensions
+    from model_builder import build_model
+
+    class_names = get_class_names()
+    paths, labels = list_split(path, class_names)
+    mel_dims = get_sample_dimensions(path_test=path)
+    model = build_model(np.zeros((1,)+mel_dims[1:]), None, nb_classes=len(class_names))
+    model.load_weights(checkpoint_filepath)
+    embedder = embedding_model(model)
+    dim = embedder.output_shape[-1]
+
+    embeddings = np.lib.format.open_memmap(outfile, mode='w+', dtype=dtype, shape=(len(paths), dim))
+    X = np.zeros((batch_size,)+mel_dims[1:], dtype=np.float32)
+    printevery = 100
+    for b, start in enumerate(range(0, len(paths), batch_size)):
+        batch_paths = paths[start:start+batch_size]
+        if (0 == b % printevery):
+            print('\r Embedding file',start+1,'of',len(paths),': ',batch_paths[0])
+        load_melgrams(batch_paths, mel_dims, X=X[0:len(batch_paths)])
+        embeddings[start:start+len(batch_paths)] = embedder.predict(X[0:len(batch_paths)], batch_size=batch_size)
+    embeddings.flush()
+
+    with open(outfile+'.paths.txt', 'w') as f:
+        for audio_path, label in zip(paths, labels):
+            f.write('{}\t{}\n'.format(label, audio_path))
+    return embeddings
+
+def load_paths(embeddings_file):
+    with open(embeddings_file+'.paths.txt') as f:
+        return [line.rstrip('\n').split('\t', 1)[1] for line in f]
+
+
+def normalize(X):
+    X = np.asarray(X, dtype=np.float32)
+    norms = np.sqrt((X*X).sum(axis=-1, keepdims=True))
+    return X / np.maximum(norms, 1e-12)
+
+def top_k(sims, k):   # indices of the k largest values, largest first
+    k = min(k, len(sims))
+    idx = np.argpartition(-sims, k-1)[0:k]
+    return idx[np.argsort(-sims[idx])]
+
+def brute_force_search(X, queries, k=10, chunk_size=65536):
+    queries = normalize(queries)
+    best_ids = [np.zeros(0, dtype=np.int64) for q in queries]
+    best_sims = [np.zeros(0, dtype=np.float32) for q in queries]
+    for start in range(0, X.shape[0], chunk_size):   # chunked, so X can be a memmap bigger than RAM
+        sims = normalize(X[start:start+chunk_size]).dot(queries.T)
+        for i in range(len(queries)):
+            ids = top_k(sims[:,i], k)
+            all_ids = np.concatenate([best_ids[i], ids + start])
+            all_sims = np.concatenate([best_sims[i], sims[ids,i]])
+            keep = top_k(all_sims, k)
+            best_ids[i], best_sims[i] = all_ids[keep], all_sims[keep]
+    return best_ids, best_sims
+
+
+class IVFIndex(object):
+    def __init__(self, centroids=None, offsets=None, ids=None, vectors=None):
+        self.centroids = centroids   # (n_lists, dim)
+        self.offsets = offsets       # list l holds rows offsets[l]:offsets[l+1] of ids/vectors
+        self.ids = ids               # original row of each stored vector
+        self.vectors = vectors       # normalized float16 vectors, grouped by list
+
+    def fit(self, X, n_lists=256, n_train=100000, chunk_size=65536, seed=1):
+        rng = np.random.RandomState(seed)
+        sample = rng.choice(X.shape[0], min(n_train, X.shape[0]), replace=False)
+        if (n_lists > len(sample)):    # k-means needs at least one sample per centroid
+            print("Only",len(sample),"training vectors for",n_lists,"lists: using",len(sample),"lists")
+            n_lists = len(sample)
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=seed)
+        kmeans.fit(normalize(X[np.sort(sample)]))
+        self.centroids = normalize(kmeans.cluster_centers_)
+
+        assignments = np.zeros(X.shape[0], dtype=np.int32)
+        for start in range(0, X.shape[0], chunk_size):
+            assignments[start:start+chunk_size] = np.argmax(normalize(X[start:start+chunk_size]).dot(self.centroids.T), axis=1)
+        self.ids = np.argsort(assignments, kind='mergesort')
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        self.vectors = np.zeros((X.shape[0], X.shape[1]), dtype=np.float16)
+        for start in range(0, X.shape[0], chunk_size):
+            rows = self.ids[start:start+chunk_size]
+            self.vectors[start:start+len(rows)] = normalize(X[np.sort(rows)])[np.argsort(np.argsort(rows))]
+        return self
+
+    def search(self, queries, k=10, n_probe=8):
+        queries = normalize(queries)
+        all_ids = []
+        all_sims = []
+        for q in queries:
+            lists = top_k(self.centroids.dot(q), n_probe)
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l+1]) for l in lists])
+            sims = self.vectors[rows].astype(np.float32).dot(q)
+            best = top_k(sims, k) if len(rows) else np.zeros(0, dtype=np.int64)
+            all_ids.append(self.ids[rows[best]])
+            all_sims.append(sims[best])
+        return all_ids, all_sims
+
+    def find_duplicates(self, threshold=0.99, block_size=4096):   # pairs (i, j, sim) within the same list
+        pairs = []
+        for l in range(len(self.centroids)):
+            V = self.vectors[self.offsets[l]:self.offsets[l+1]].astype(np.float32)
+            ids = self.ids[self.offsets[l]:self.offsets[l+1]]
+            for start in range(0, V.shape[0], block_size):
+                sims = V[start:start+block_size].dot(V.T)
+                for a, b in zip(*np.nonzero(sims >= threshold)):
+                    if (start + a < b):
+                        pairs.append((int(ids[start+a]), int(ids[b]), float(sims[a, b])))
+        return pairs
+
+    def save(self, filename):
+        np.savez(filename, centroids=self.centroids, offsets=self.offsets, ids=self.ids, vectors=self.vectors)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['centroids'], data['offsets'], data['ids'], data['vectors'])
+
+
+def benchmark(index, X, n_queries=1000, k=10, n_probes=(1, 2, 4, 8, 16), seed=1):
+    rng = np.random.RandomState(seed)
+    queries = np.asarray(X[np.sort(rng.choice(X.shape[0], min(n_queries, X.shape[0]), replace=False))])
+    true_ids = brute_force_search(X, queries, k=k)[0]    # exact neighbours, all queries in one pass over X
+    # brute-force latency: one query at a time, like IVFIndex.search, over the index's already normalized
+    # vectors, so the ms/query figures compare the scans and not re-reading/normalizing X
+    V = index.vectors.astype(np.float32)
+    start = time.time()
+    for q in normalize(queries):
+        index.ids[top_k(V.dot(q), k)]
+    brute_time = (time.time() - start) / len(queries)
+    print('{:>8s} {:>10s} {:>14s}'.format("n_probe","recall@"+str(k),"ms/query"))
+    print('{:>8s} {:10.4f} {:14.3f}'.format("brute", 1.0, brute_time*1000))
+    results = []
+    for n_probe in n_probes:
+        start = time.time()
+        ids, _ = index.search(queries, k=k, n_probe=n_probe)
+        query_time = (time.time() - start) / len(queries)
+        recall = np.mean([len(set(a) & set(b)) / float(len(b)) for a, b in zip(ids, true_ids)])
+        print('{:8d} {:10.4f} {:14.3f}'.format(n_probe, recall, query_time*1000))
+        results.append((n_probe, recall, query_time))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Clip embeddings and nearest-neighbour search")
+    subparsers = parser.add_subparsers(dest='command')
+    p = subparsers.add_parser('extract', help='embed every clip of a Preproc/ split')
+    p.add_argument('--split', default='Preproc/Preproc_Test/')
+    p.add_argument('--weights', default='weights1.hdf5')
+    p.add_argument('--out', default='embeddings.npy')
+    p.add_argument('--batch_size', type=int, default=128)
+    p = subparsers.add_parser('index', help='build an IVF index over extracted embeddings')
+    p.add_argument('--embeddings', default='embeddings.npy')
+    p.add_argument('--out', default='index.npz')
+    p.add_argument('--lists', type=int, default=256, help='number of k-means buckets (~sqrt of the number of clips)')
+    p = subparsers.add_parser('query', help='find the clips most similar to a clip')
+    p.add_argument('--index', default='index.npz')
+    p.add_argument('--embeddings', default='embeddings.npy')
+    p.add_argument('--clip', required=True, help='path of a clip in the embeddings\' paths file')
+    p.add_argument('-k', type=int, default=10)
+    p.add_argument('--probe', type=int, default=8, help='number of buckets to scan')
+    p = subparsers.add_parser('dedup', help='list near-duplicate clip pairs')
+    p.add_argument('--index', default='index.npz')
+    p.add_argument('--embeddings', default='embeddings.npy')
+    p.add_argument('--threshold', type=float, default=0.99)
+    p = subparsers.add_parser('bench', help='recall and query latency vs. brute force')
+    p.add_argument('--index', default='index.npz')
+    p.add_argument('--embeddings', default='embeddings.npy')
+    p.add_argument('--queries', type=int, default=1000)
+    p.add_argument('-k', type=int, default=10)
+    p.add_argument('--probes', default='1,2,4,8,16')
+    args = parser.parse_args()
+
+    if (args.command == 'extract'):
+        extract_embeddings(args.split, args.out, checkpoint_filepath=args.weights, batch_size=args.batch_size)
+    elif (args.command == 'index'):
+        X = np.load(args.embeddings, mmap_mode='r')
+        IVFIndex().fit(X, n_lists=args.lists).save(args.out)
+    elif (args.command == 'query'):
+        index = IVFIndex.load(args.index)
+        paths = load_paths(args.embeddings)
+        X = np.load(args.embeddings, mmap_mode='r')
+        ids, sims = index.search(X[paths.index(args.clip)][np.newaxis,:], k=args.k, n_probe=args.probe)
+        for idx, sim in zip(ids[0], sims[0]):
+            print('{:.4f}  {}'.format(sim, paths[idx]))
+    elif (args.command == 'dedup'):
+        paths = load_paths(args.embeddings)
+        for i, j, sim in IVFIndex.load(args.index).find_duplicates(threshold=args.threshold):
+            print('{:.4f}  {}  {}'.format(sim, paths[i], paths[j]))
+    elif (args.command == 'bench'):
+        benchmark(IVFIndex.load(args.index), np.load(args.embeddings, mmap_mode='r'),
+                  n_queries=args.queries, k=args.k, n_probes=[int(n) for n in args.probes.split(',')])
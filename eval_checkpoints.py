@@ -0,0 +1,138 @@
+from __future__ import print_function
+
+'''
+Compare many checkpoints on the same test set
+
+The test split is read once into a memory-mapped .npy, the model graph is built once, and
+only the weights are swapped per checkpoint.  With --workers N the checkpoints are scored by
+N processes, each with its own model, all reading the same memory-mapped test set.
+
+The .npy is named after a hash of the split's file list (paths, sizes, mtimes) and crop shape,
+so an unchanged test set is reused across runs and concurrent runs never write the same file.
+
+Usage:
+    python eval_checkpoints.py weights*.hdf5
+    python eval_checkpoints.py weights*.hdf5 --workers 4 --out checkpoint_scores.csv
+'''
+import numpy as np
+import argparse
+import hashlib
+import multiprocessing
+import time
+import os
+from os.path import isfile
+
+from sklearn.metrics import roc_auc_score
+
+# eval_network (and with it keras) is imported inside the functions below, never at module level:
+# the worker pool has to fork before keras is loaded in this process.
+
+
+def cache_test_set(path_test="Preproc/Preproc_Test/", path_train="Preproc/Preproc_Train/", cache_dir="PredCache/"):
+    from eval_network import get_class_names, get_sample_dimensions, get_test_files
+    from preproc_files import load_melgrams
+    class_names = get_class_names(path_train=path_train)
+    paths_test, Y_test = get_test_files(path_test, class_names)
+    mel_dims = get_sample_dimensions(path_test=path_test)
+
+    h = hashlib.sha1(str(mel_dims).encode('utf-8'))
+    for audio_path in paths_test:
+        st = os.stat(audio_path)
+        h.update('{}|{}|{}\n'.format(audio_path, st.st_size, st.st_mtime).encode('utf-8'))
+    cache_file = cache_dir + 'test_set_' + h.hexdigest() + '.npy'
+
+    if not isfile(cache_file):
+        if not os.path.exists(cache_dir):
+            os.mkdir( cache_dir, 0o755 )
+        tmp_file = cache_file + '.' + str(os.getpid()) + '.tmp'    # private to this run until renamed
+        X = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32,
+                                      shape=(len(paths_test), mel_dims[1], mel_dims[2], mel_dims[3]))
+        print("Loading",len(paths_test),"test files into",cache_file)
+        load_melgrams(paths_test, mel_dims, X=X)
+        X.flush()
+        del X
+        os.rename(tmp_file, cache_file)
+    return np.load(cache_file, mmap_mode='r'), Y_test, class_names, cache_file
+
+def build_warm_model(X_test, nb_classes, batch_size):   # the first predict builds the graph; keep that out of the timings
+    from model_builder import build_model
+    model = build_model(X_test, None, nb_classes)
+    model.predict(X_test[0:batch_size], batch_size=batch_size)
+    return model
+
+def score_checkpoint(model, checkpoint_filepath, X_test, Y_test, batch_size):
+    from eval_network import score_predictions
+    model.load_weights(checkpoint_filepath)
+    start = time.time()
+    y_scores = model.predict(X_test, batch_size=batch_size)
+    pred_time = time.time() - start
+    loss, accuracy = score_predictions(Y_test, y_scores)
+    return {"checkpoint": checkpoint_filepath, "loss": loss, "accuracy": accuracy,
+            "auc": roc_auc_score(Y_test, y_scores), "time": pred_time}
+
+
+# per-process state of the worker pool: the model is built on the first task, reused for the rest
+worker_state = {}
+
+def init_worker(threads):
+    from parallel_train import set_threads
+    set_threads(threads)
+
+def score_in_worker(task):
+    checkpoint_filepath, cache_file, Y_test, nb_classes, batch_size = task
+    if (worker_state.get("cache_file") != cache_file):
+        worker_state["cache_file"] = cache_file
+        worker_state["X_test"] = np.load(cache_file, mmap_mode='r')
+        worker_state["model"] = build_warm_model(worker_state["X_test"], nb_classes, batch_size)
+    return score_checkpoint(worker_state["model"], checkpoint_filepath, worker_state["X_test"], Y_test, batch_size)
+
+def evaluate_checkpoints(checkpoints, n_workers=1, batch_size=None):
+    from batch_autotune import load_batch_size
+    pool = None
+    if (n_workers > 1):
+        # fork before cache_test_set imports keras here, so each worker starts with a clean backend
+        threads = max(1, multiprocessing.cpu_count() // n_workers)
+        pool = multiprocessing.Pool(n_workers, initializer=init_worker, initargs=(threads,))
+
+    X_test, Y_test, class_names, cache_file = cache_test_set()
+    if batch_size is None:
+        batch_size = load_batch_size('predict', X_test.shape[1:], default=128)   # see batch_autotune.py
+    if pool is not None:
+        tasks = [(checkpoint_filepath, cache_file, Y_test, len(class_names), batch_size) for checkpoint_filepath in checkpoints]
+        results = pool.map(score_in_worker, tasks, chunksize=1)
+        pool.close()
+        pool.join()
+    else:
+        model = build_warm_model(X_test, len(class_names), batch_size)
+        results = []
+        for checkpoint_filepath in checkpoints:
+            print("Scoring",checkpoint_filepath)
+            results.append(score_checkpoint(model, checkpoint_filepath, X_test, Y_test, batch_size))
+    return results
+
+def print_table(results):
+    width = max([len("checkpoint")] + [len(r["checkpoint"]) for r in results])
+    print('{:{w}s} {:>10s} {:>10s} {:>10s} {:>10s}'.format("checkpoint","loss","accuracy","AUC","time(s)",w=width))
+    for r in results:
+        print('{:{w}s} {:10.4f} {:10.4f} {:10.4f} {:10.3f}'.format(r["checkpoint"], r["loss"], r["accuracy"],
+              r["auc"], r["time"], w=width))
+
+def save_table(results, filename):
+    with open(filename, 'w') as f:
+        f.write("checkpoint,loss,accuracy,auc,time\n")
+        for r in results:
+            f.write('{},{},{},{},{}\n'.format(r["checkpoint"], r["loss"], r["accuracy"], r["auc"], r["time"]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score several checkpoints on Preproc/Preproc_Test/")
+    parser.add_argument('checkpoints', nargs='+', help='weights files, e.g. weights*.hdf5')
+    parser.add_argument('--workers', type=int, default=1, help='score checkpoints in N parallel processes')
+    parser.add_argument('--batch_size', type=int, default=None)
+    parser.add_argument('--out', default=None, help='also write the table to this CSV file')
+    args = parser.parse_args()
+
+    results = evaluate_checkpoints(args.checkpoints, n_workers=args.workers, batch_size=args.batch_size)
+    print_table(results)
+    if (args.out):
+        save_table(results, args.out)
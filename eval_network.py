@@ -34,6 +34,12 @@ from os.path import isfile
 from sklearn.metrics import roc_auc_score
 from timeit import default_timer as timer
 from sklearn.metrics import roc_auc_score, roc_curve, auc
+from model_builder import build_model, load_model_config
+from batch_autotune import load_batch_size
+from prediction_cache import PredictionCache
+from preproc_files import list_split, load_melgrams, one_hot
+import argparse
+import json
 
 mono=True
 
@@ -210,37 +216,71 @@ def build_datasets(train_percentage=0.8, preproc=False):
     return X_train, Y_train, paths_train, X_test, Y_test, paths_test, class_names, sr
 
 
+def get_test_files(path_test, class_names):   # paths & one-hot labels of the test split, without loading any data
+    paths_test, labels = list_split(path_test, class_names)
+    return paths_test, one_hot(labels, class_names)
+
+def score_predictions(Y_test, y_scores, epsilon=1e-7):   # [loss, accuracy] as model.evaluate would give them
+    clipped = np.clip(y_scores, epsilon, 1.0-epsilon)
+    loss = float(np.mean(-np.sum(Y_test*np.log(clipped), axis=1)))
+    accuracy = float(np.mean(np.argmax(y_scores, axis=1) == np.argmax(Y_test, axis=1)))
+    return [loss, accuracy]
+
+def predict_incremental(checkpoint_filepath, path_test="Preproc/Preproc_Test/", path_train="Preproc/Preproc_Train/",
+                        batch_size=None, use_cache=True, cache_dir="PredCache/"):
+    '''
+    Predicts the test split only (the training split is never loaded). Clips whose feature file
+    and checkpoint are unchanged since an earlier run get their cached prediction, and the model
+    is only built if any clip is left to predict.
+    Returns y_scores, Y_test, paths_test, class_names and the time spent predicting.
+    '''
+    class_names = get_class_names(path_train=path_train)
+    paths_test, Y_test = get_test_files(path_test, class_names)
+    mel_dims = get_sample_dimensions(path_test=path_test)    # crop width comes from whichever file is listed first
+    y_scores = np.zeros(Y_test.shape)
+    cache = None
+    if use_cache:
+        settings = json.dumps({"crop": list(mel_dims[1:]), "config": load_model_config()}, sort_keys=True)
+        cache = PredictionCache(checkpoint_filepath, cache_dir=cache_dir, settings=settings)
+    hashes = []
+    stale = []
+    for idx, audio_path in enumerate(paths_test):
+        pred = None
+        if cache is not None:
+            hashes.append(cache.feature_hash(audio_path))
+            pred = cache.get(hashes[idx])
+        if pred is None:
+            stale.append(idx)
+        else:
+            y_scores[idx] = pred
+    print("   ",len(paths_test)-len(stale),"cached predictions,",len(stale),"clips to predict")
+
+    pred_time = 0.0
+    if stale:
+        X = load_melgrams([paths_test[idx] for idx in stale], mel_dims)
+        model = build_model(X, None, nb_classes=len(class_names))
+        model.load_weights(checkpoint_filepath)
+        if batch_size is None:
+            batch_size = load_batch_size('predict', mel_dims[1:], default=128)   # see batch_autotune.py
+        start = time.time()
+        preds = model.predict(X, batch_size=batch_size)
+        pred_time = time.time() - start
+        for idx, pred in zip(stale, preds):
+            y_scores[idx] = pred
+            if cache is not None:
+                cache.put(hashes[idx], pred)
+    if cache is not None:
+        cache.prune(set(hashes))     # changed or removed clips would otherwise pile up in the cache file
+        cache.save()
+    return y_scores, Y_test, paths_test, class_names, pred_time
+
 
-def build_model(X,Y,nb_classes):
-    nb_filters = 32  # number of convolutional filters to use
-    pool_size = (2, 2)  # size of pooling area for max pooling
-    kernel_size = (3, 3)  # convolution kernel size
-    nb_layers = 4
-    input_shape = (1, X.shape[2], X.shape[3])
-
-    model = Sequential()
-    model.add(Convolution2D(nb_filters, (kernel_size[0], kernel_size[1]),
-                        border_mode='valid', input_shape=input_shape, data_format='channels_first'))
-    model.add(BatchNormalization(axis=1))
-    model.add(Activation('relu'))
-
-    for layer in range(nb_layers-1):
-        model.add(Convolution2D(nb_filters, kernel_size[0], kernel_size[1]))
-        model.add(BatchNormalization(axis=1))
-        model.add(ELU(alpha=1.0))  
-        model.add(MaxPooling2D(pool_size=pool_size))
-        model.add(Dropout(0.25))
-
-    model.add(Flatten())
-    model.add(Dense(128))
-    model.add(Activation('relu'))
-    model.add(Dropout(0.5))
-    model.add(Dense(nb_classes))
-    model.add(Activation("softmax"))
-    return model
-    
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Evaluate weights1.hdf5 on Preproc/Preproc_Test/")
+    parser.add_argument('--no_cache', action='store_true', help='re-predict every clip instead of using PredCache/')
+    args = parser.parse_args()
+
     i = 1
     test_result = []
     roc_result = []
@@ -249,57 +289,28 @@ if __name__ == '__main__':
     while (i < 2):
 	    np.random.seed(1)
 
-	    # get the data
-	    X_train, Y_train, paths_train, X_test, Y_test, paths_test, class_names, sr = build_datasets(preproc=True)
-
-	    # make the model
-	    model = build_model(X_train,Y_train, nb_classes=len(class_names))
-	    model.compile(loss='categorical_crossentropy',
-		      optimizer='adadelta',
-		      metrics=['accuracy'])
-	    model.summary()
-
-	    # Initialize weights using checkpoint if it exists. (Checkpointing requires h5py)
+	    # Only the test split is read, and only clips without a cached prediction go through the model
 	    checkpoint_filepath = 'weights1.hdf5'
-	    if (True):
-		print("Looking for previous weights...")
-		if ( isfile(checkpoint_filepath) ):
-		    print ('Checkpoint file detected. Loading weights.')
-		    model.load_weights(checkpoint_filepath)
-		else:
-		    print ('No checkpoint file detected. You gotta train_network first.')
-		    exit(1) 
-	    else:
-		print('Starting from scratch (no checkpoint)')
-
-
+	    if not ( isfile(checkpoint_filepath) ):
+		print ('No checkpoint file detected. You gotta train_network first.')
+		exit(1) 
+	    print("Predicting test set...")
+	    y_scores, Y_test, paths_test, class_names, pred_time = predict_incremental(checkpoint_filepath, use_cache=not args.no_cache)
 	    print("class names = ",class_names)
 
-	    batch_size = 128
-	    num_pred = X_test.shape[0]
-
 	    # evaluate the model
-	    print("Running model.evaluate...")
-	    scores = model.evaluate(X_test, Y_test, verbose=1, batch_size=batch_size)
+	    scores = score_predictions(Y_test, y_scores)
 	    print('Test score:', scores[0])
 	    print('Test accuracy:', scores[1])
 
-	    
-	    print("Running predict_proba...")
-            start = time.clock() 
-	    y_scores = model.predict_proba(X_test[0:num_pred,:,:,:],batch_size=batch_size)
-            end = time.clock()
 	    auc_score = roc_auc_score(Y_test, y_scores)
 	    print("AUC = ",auc_score)
-            print("test time: {} ".format((end-start))) 
+            print("test time: {} ".format(pred_time)) 
             test_result.append(scores)
-            testtime.append(end-start)
+            testtime.append(pred_time)
             roc_result.append(auc_score)
             testtime_average.append(sum(testtime)/len(testtime))
 
-
-
-            
 	    n_classes = len(class_names)
 
 	    print(" Counting mistakes ")
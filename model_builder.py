@@ -0,0 +1,192 @@
+from __future__ import print_function
+
+'''
+Configurable model builder, shared by train_network.py and eval_network.py
+
+The architecture is described by a small JSON config (see model_config.json and
+model_config.py, which reads it).
+
+Usage:
+    python model_builder.py                                 # params / FLOPs / latency of model_config.json
+    python model_builder.py --search candidates.json        # train candidates, print accuracy vs. latency Pareto front
+'''
+import numpy as np
+import json
+import time
+import contextlib
+import argparse
+
+from keras.models import Sequential
+from keras.layers import Dense, Dropout, Activation
+from keras.layers import Convolution2D, MaxPooling2D, Flatten
+from keras.layers.normalization import BatchNormalization
+from keras.layers.advanced_activations import ELU
+from keras import backend
+
+from model_config import DEFAULT_CONFIG, check_config_keys, load_model_config
+
+def build_model(X,Y,nb_classes,config=None):
+    if config is None:
+        config = load_model_config()
+    nb_filters = config["nb_filters"]
+    pool_size = tuple(config["pool_size"])
+    kernel_size = tuple(config["kernel_size"])
+    nb_layers = config["nb_layers"]
+    input_shape = (1, X.shape[2], X.shape[3])
+
+    model = Sequential()
+    model.add(Convolution2D(nb_filters, (kernel_size[0], kernel_size[1]),
+                        border_mode='valid', input_shape=input_shape, data_format='channels_first'))
+    model.add(BatchNormalization(axis=1))
+    model.add(Activation('relu'))
+
+    for layer in range(nb_layers-1):
+        model.add(Convolution2D(nb_filters, kernel_size[0], kernel_size[1]))
+        model.add(BatchNormalization(axis=1))
+        model.add(ELU(alpha=1.0))
+        model.add(MaxPooling2D(pool_size=pool_size))
+        model.add(Dropout(config["conv_dropout"]))
+
+    model.add(Flatten())
+    model.add(Dense(config["nb_dense"]))
+    model.add(Activation('relu'))
+    model.add(Dropout(config["dense_dropout"]))
+    model.add(Dense(nb_classes))
+    model.add(Activation("softmax"))
+    return model
+
+
+def count_flops(model):   # multiply-adds count as 2 FLOPs; elementwise layers as 1 per output value
+    flops = 0
+    for layer in model.layers:
+        out_shape = layer.output_shape[1:]
+        n_out = int(np.prod(out_shape))
+        if isinstance(layer, Convolution2D):
+            kernel_shape = backend.int_shape(layer.kernel)     # (kh, kw, in_channels, filters)
+            if layer.data_format == 'channels_first':
+                n_positions = int(np.prod(out_shape[1:]))
+            else:
+                n_positions = int(np.prod(out_shape[:-1]))
+            flops += 2 * int(np.prod(kernel_shape)) * n_positions
+        elif isinstance(layer, Dense):
+            kernel_shape = backend.int_shape(layer.kernel)     # (in, out)
+            flops += 2 * int(np.prod(kernel_shape))
+        elif isinstance(layer, (Dropout, Flatten)):
+            pass                        # no-ops at inference time
+        else:
+            flops += n_out               # batchnorm, activations, pooling
+    return flops
+
+@contextlib.contextmanager
+def cpu_device():   # layers built inside are placed on the CPU, even if a GPU is visible
+    if backend.backend() == 'tensorflow':
+        import tensorflow as tf
+        with tf.device('/cpu:0'):
+            yield
+    else:
+        yield
+
+def measure_latency(config, input_shape, nb_classes, weights=None, n_runs=50, n_warmup=5):   # median CPU seconds per single clip
+    x = np.random.rand(*((1,)+tuple(input_shape))).astype(np.float32)
+    with cpu_device():     # a CPU-only copy of the model, so the figure is CPU latency on any machine
+        model = build_model(x, None, nb_classes, config=config)
+    if weights is not None:
+        model.set_weights(weights)
+    for i in range(n_warmup):
+        model.predict(x, batch_size=1)
+    times = []
+    for i in range(n_runs):
+        start = time.time()
+        model.predict(x, batch_size=1)
+        times.append(time.time() - start)
+    return float(np.median(times))
+
+def estimate_model(config, input_shape, nb_classes, n_runs=50):
+    X = np.zeros((1,)+tuple(input_shape))
+    model = build_model(X, None, nb_classes, config=config)
+    return {"params": model.count_params(),
+            "flops": count_flops(model),
+            "latency": measure_latency(config, input_shape, nb_classes, n_runs=n_runs)}
+
+
+def pareto_front(results):   # keeps results not beaten on both accuracy (higher) and latency (lower)
+    front = []
+    for r in results:
+        dominated = False
+        for other in results:
+            if (other["accuracy"] >= r["accuracy"] and other["latency"] <= r["latency"] and
+                    (other["accuracy"] > r["accuracy"] or other["latency"] < r["latency"])):
+                dominated = True
+                break
+        if not dominated:
+            front.append(r)
+    return sorted(front, key=lambda r: r["latency"])
+
+def search_models(candidates, X_train, Y_train, X_test, Y_test, nb_classes, nb_epoch=10, batch_size=10, base_config=None):
+    if base_config is None:
+        base_config = DEFAULT_CONFIG
+    results = []
+    for idx, candidate in enumerate(candidates):   # each candidate overrides keys of base_config
+        check_config_keys(candidate, "candidate "+str(idx+1))
+        config = dict(base_config)
+        config.update(candidate)
+        print("Candidate",idx+1,"of",len(candidates),":",config)
+        model = build_model(X_train, Y_train, nb_classes, config=config)
+        model.compile(loss='categorical_crossentropy',
+                      optimizer='adadelta',
+                      metrics=['accuracy'])
+        model.fit(X_train, Y_train, batch_size=batch_size, nb_epoch=nb_epoch,
+                  verbose=0, validation_data=(X_test, Y_test))
+        score = model.evaluate(X_test, Y_test, verbose=0)
+        result = {"config": config,
+                  "accuracy": score[1],
+                  "params": model.count_params(),
+                  "flops": count_flops(model),
+                  "latency": measure_latency(config, X_train.shape[1:], nb_classes, weights=model.get_weights())}
+        print("   accuracy = ",result["accuracy"],", latency = ",result["latency"]*1000,"ms/clip",sep="")
+        results.append(result)
+    return results, pareto_front(results)
+
+def print_results(results):
+    print('{:>10s} {:>12s} {:>14s} {:>8s}  config'.format("params","MFLOPs","latency(ms)","acc"))
+    for r in results:
+        print('{:10d} {:12.2f} {:14.3f} {:>8s}  {}'.format(r["params"], r["flops"]/1e6, r["latency"]*1000,
+              '{:.4f}'.format(r["accuracy"]) if "accuracy" in r else "-", json.dumps(r.get("config", {}), sort_keys=True)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Estimate params/FLOPs/latency of a model config, or search over configs")
+    parser.add_argument('--config', default="model_config.json", help='model config file (JSON)')
+    parser.add_argument('--search', metavar='CANDIDATES', help='JSON list of partial configs to train and compare')
+    parser.add_argument('--input_shape', default=None, help='e.g. 1,96,173 (default: shape of the first preprocessed file)')
+    parser.add_argument('--nb_classes', type=int, default=None)
+    parser.add_argument('--epochs', type=int, default=10, help='training epochs per search candidate')
+    args = parser.parse_args()
+
+    if (args.search):
+        from train_network import build_datasets
+        np.random.seed(1)
+        X_train, Y_train, paths_train, X_test, Y_test, paths_test, class_names, sr = build_datasets(preproc=True)
+        with open(args.search) as f:
+            candidates = json.load(f)
+        results, front = search_models(candidates, X_train, Y_train, X_test, Y_test, len(class_names), nb_epoch=args.epochs,
+                                       base_config=load_model_config(args.config))
+        print("All candidates:")
+        print_results(results)
+        print("Pareto front (accuracy vs. latency):")
+        print_results(front)
+    else:
+        if (args.input_shape is not None):
+            input_shape = tuple(int(d) for d in args.input_shape.split(','))
+        else:
+            from train_network import get_sample_dimensions
+            input_shape = get_sample_dimensions()[1:]
+        nb_classes = args.nb_classes
+        if nb_classes is None:
+            from train_network import get_class_names
+            nb_classes = len(get_class_names())
+        config = load_model_config(args.config)
+        result = estimate_model(config, input_shape, nb_classes)
+        result["config"] = config
+        print("input_shape = ",input_shape)
+        print_results([result])
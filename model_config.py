@@ -0,0 +1,37 @@
+from __future__ import print_function
+
+'''
+Model config, read from model_config.json by model_builder.py
+
+Missing keys fall back to DEFAULT_CONFIG, which reproduces the original
+hard-coded network (4 conv layers of 32 3x3 filters, 2x2 pooling, Dense(128)).
+Kept apart from model_builder.py so the config can be read without importing keras
+(batch_autotune.py does, before it forks its measuring processes).
+'''
+import json
+from os.path import isfile
+
+DEFAULT_CONFIG = {
+    "nb_filters": 32,       # number of convolutional filters to use
+    "nb_layers": 4,
+    "kernel_size": [3, 3],  # convolution kernel size
+    "pool_size": [2, 2],    # size of pooling area for max pooling
+    "conv_dropout": 0.25,
+    "nb_dense": 128,
+    "dense_dropout": 0.5,
+}
+
+def check_config_keys(config, source):   # a misspelt key would otherwise silently fall back to the default
+    unknown = sorted(set(config) - set(DEFAULT_CONFIG))
+    if unknown:
+        raise ValueError("Unknown model config key(s) in "+source+": "+", ".join(unknown)+
+                         " (valid keys: "+", ".join(sorted(DEFAULT_CONFIG))+")")
+
+def load_model_config(config_path="model_config.json"):  # missing file or keys fall back to DEFAULT_CONFIG
+    config = dict(DEFAULT_CONFIG)
+    if ( isfile(config_path) ):
+        with open(config_path) as f:
+            file_config = json.load(f)
+        check_config_keys(file_config, config_path)
+        config.update(file_config)
+    return config
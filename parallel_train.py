@@ -0,0 +1,200 @@
+from __future__ import print_function
+
+'''
+Data-parallel CPU training over several worker processes
+
+Each worker trains a copy of the model on its own shard of Preproc/Preproc_Train/, and every
+`sync_every` steps sends its weights to a coordinator, which averages them and sends the
+average back (sync_every=1 averages after every step).  Optimizer state stays local to each
+worker.  Workers and coordinator talk over multiprocessing.connection, so they can be local
+processes or processes on other machines of the local network.
+
+The connections are authenticated with a shared key (--authkey or $PARALLEL_TRAIN_AUTHKEY), but
+messages are unpickled and not encrypted: never expose the port outside a trusted network.
+Local runs without a key use a random one.
+
+Rank 0 saves the final weights to --weights (weights_parallel.hdf5), and refuses to start if
+that file already exists, so it never overwrites train_network.py's weights1.hdf5.
+
+Usage:
+    python parallel_train.py --workers 4                         # coordinator + 4 local workers
+    python parallel_train.py --scaling 1,2,4,8 --epochs 1        # samples/s vs. worker count
+    export PARALLEL_TRAIN_AUTHKEY=<shared secret>
+    python parallel_train.py --role coordinator --address 0.0.0.0:6000 --world_size 8
+    python parallel_train.py --role worker --address head:6000 --world_size 8 --rank 3
+'''
+import numpy as np
+import argparse
+import time
+import os
+from os.path import isfile
+import multiprocessing
+from multiprocessing.connection import Listener, Client
+from preproc_files import list_split, load_melgrams, one_hot
+
+
+def shard_indices(n_samples, rank, world_size):   # every world_size-th sample, starting at rank
+    return np.arange(rank, n_samples, world_size)
+
+def average_weights(weight_lists):
+    return [np.mean(np.array(layer_weights), axis=0) for layer_weights in zip(*weight_lists)]
+
+def set_threads(threads):   # keep N workers on one host from fighting over the same cores
+    from keras import backend
+    if backend.backend() == 'tensorflow':
+        import tensorflow as tf
+        backend.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                             inter_op_parallelism_threads=1)))
+
+
+def worker_main(rank, world_size, address, authkey, nb_epoch=100, batch_size=10, sync_every=1, threads=None,
+                checkpoint_filepath='weights_parallel.hdf5', path_train="Preproc/Preproc_Train/", path_val="Preproc/Preproc_Validation/"):
+    # checkpoint_filepath=None: don't save the weights (e.g. scaling runs)
+    if (0 == rank) and (checkpoint_filepath is not None) and isfile(checkpoint_filepath):
+        raise IOError(checkpoint_filepath+" already exists; remove it or pass another --weights")
+    # keras is imported here, not at module level, so forked workers each get a fresh backend
+    if threads is not None:
+        set_threads(threads)
+    from model_builder import build_model
+
+    # only this worker's shard of the training split is ever loaded
+    files = list(zip(*list_split(path_train)))    # sorted (path, classname): the same order on every host
+    steps_per_epoch = (len(files) // world_size) // batch_size   # same on every worker, so syncs line up
+    shard = [files[idx] for idx in shard_indices(len(files), rank, world_size)]
+    mel_dims = np.load(files[0][0]).shape     # crop width from the same file on every host
+    X_shard = load_melgrams([audio_path for audio_path, classname in shard], mel_dims)
+    class_names = os.listdir(path_train)      # same order as get_class_names in train_network.py / eval_network.py
+
+    model = build_model(X_shard, None, nb_classes=len(class_names))
+    model.compile(loss='categorical_crossentropy',
+                  optimizer='adadelta',
+                  metrics=['accuracy'])
+
+    conn = Client(address, authkey=authkey)
+    conn.send(('init', rank, (model.get_weights(), class_names)))
+    weights, class_names = conn.recv()    # everyone starts from rank 0's initial weights and class order
+    model.set_weights(weights)
+    Y_shard = one_hot([classname for audio_path, classname in shard], class_names)
+    if (0 == rank):
+        val_paths, val_labels = list_split(path_val)
+        X_test = load_melgrams(val_paths, mel_dims)
+        Y_test = one_hot(val_labels, class_names)
+
+    np.random.seed(1 + rank)
+    n_samples = 0
+    train_time = 0.0
+    for epoch in range(nb_epoch):
+        start = time.time()
+        order = np.random.permutation(X_shard.shape[0])
+        for step in range(steps_per_epoch):
+            batch = order[step*batch_size:(step+1)*batch_size]
+            model.train_on_batch(X_shard[batch], Y_shard[batch])
+            n_samples += len(batch)
+            if (0 == (step+1) % sync_every) or (step == steps_per_epoch-1):
+                conn.send(('sync', rank, model.get_weights()))
+                model.set_weights(conn.recv())
+        train_time += time.time() - start
+        if (0 == rank):
+            score = model.evaluate(X_test, Y_test, verbose=0)
+            print('Epoch {:3d}: val loss = {:.4f}, val acc = {:.4f}'.format(epoch+1, score[0], score[1]))
+
+    if (0 == rank) and (checkpoint_filepath is not None):
+        model.save_weights(checkpoint_filepath)
+    conn.send(('done', rank, (n_samples, train_time)))
+    conn.close()
+
+
+def coordinate(listener, world_size):   # returns the list of (n_samples, train_time) reported by the workers
+    conns = [listener.accept() for i in range(world_size)]
+    stats = [None] * world_size
+    while True:
+        msgs = [conn.recv() for conn in conns]
+        kind = msgs[0][0]
+        if (kind == 'done'):
+            for _, rank, worker_stats in msgs:
+                stats[rank] = worker_stats
+            break
+        if (kind == 'init'):    # rank 0's initial weights and class order go to everyone
+            weights = [w for _, rank, w in msgs if rank == 0][0]
+        else:
+            weights = average_weights([w for _, rank, w in msgs])
+        for conn in conns:
+            conn.send(weights)
+    for conn in conns:
+        conn.close()
+    return stats
+
+def run_local(n_workers, nb_epoch=100, batch_size=10, sync_every=1, port=6000, authkey=None,
+              checkpoint_filepath='weights_parallel.hdf5'):
+    if authkey is None:
+        authkey = os.urandom(32)    # only this process and its children need to know it
+    address = ('localhost', port)
+    listener = Listener(address, authkey=authkey)
+    threads = max(1, multiprocessing.cpu_count() // n_workers)
+    procs = [multiprocessing.Process(target=worker_main,
+                                     args=(rank, n_workers, address, authkey, nb_epoch, batch_size, sync_every, threads, checkpoint_filepath))
+             for rank in range(n_workers)]
+    for p in procs:
+        p.start()
+    stats = coordinate(listener, n_workers)
+    for p in procs:
+        p.join()
+    listener.close()
+    return stats
+
+def throughput(stats):   # samples/s, limited by the slowest worker
+    return sum(s[0] for s in stats) / max(s[1] for s in stats)
+
+def scaling_report(worker_counts, nb_epoch=1, batch_size=10, sync_every=1, port=6000, authkey=None):
+    results = []
+    for n_workers in worker_counts:
+        print("Running with",n_workers,"workers...")
+        results.append((n_workers, throughput(run_local(n_workers, nb_epoch, batch_size, sync_every, port, authkey,
+                                                              checkpoint_filepath=None))))
+    base = results[0][1] / results[0][0]    # per-worker rate of the smallest run
+    print('{:>8s} {:>12s} {:>9s} {:>11s}'.format("workers","samples/s","speedup","efficiency"))
+    for n_workers, rate in results:
+        print('{:8d} {:12.1f} {:9.2f} {:10.0f}%'.format(n_workers, rate, rate/base, 100.0*rate/(base*n_workers)))
+    return results
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return (host, int(port))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Data-parallel training over several processes")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='number of local workers')
+    parser.add_argument('--scaling', default=None, help='comma-separated worker counts to benchmark, e.g. 1,2,4')
+    parser.add_argument('--role', choices=['local', 'coordinator', 'worker'], default='local')
+    parser.add_argument('--address', default='localhost:6000', help='coordinator host:port')
+    parser.add_argument('--world_size', type=int, default=None, help='total workers (required for coordinator/worker roles)')
+    parser.add_argument('--rank', type=int, default=0, help='this worker\'s rank (worker role)')
+    parser.add_argument('--authkey', default=os.environ.get('PARALLEL_TRAIN_AUTHKEY'),
+                        help='shared secret for the connections (default: $PARALLEL_TRAIN_AUTHKEY; required for coordinator/worker roles)')
+    parser.add_argument('--threads', type=int, default=None, help='compute threads per worker (worker role)')
+    parser.add_argument('--weights', default='weights_parallel.hdf5', help='where rank 0 saves the trained weights (must not exist)')
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=10)
+    parser.add_argument('--sync_every', type=int, default=1, help='average weights every k steps')
+    args = parser.parse_args()
+    if (args.role in ['coordinator', 'worker']) and (args.world_size is None) and not args.scaling:
+        parser.error('--world_size is required for the '+args.role+' role')
+    if (args.role in ['coordinator', 'worker']) and not args.authkey and not args.scaling:
+        parser.error('--authkey (or $PARALLEL_TRAIN_AUTHKEY) is required for the '+args.role+' role')
+    if (args.role == 'local' or (args.role == 'worker' and 0 == args.rank)) and not args.scaling and isfile(args.weights):
+        parser.error(args.weights+' already exists; remove it or pass another --weights')
+    authkey = args.authkey.encode('utf-8') if args.authkey else None
+
+    address = parse_address(args.address)
+    if (args.scaling):
+        scaling_report([int(n) for n in args.scaling.split(',')], args.epochs, args.batch_size, args.sync_every, address[1], authkey)
+    elif (args.role == 'coordinator'):
+        stats = coordinate(Listener(address, authkey=authkey), args.world_size)
+        print("samples/s = ",throughput(stats))
+    elif (args.role == 'worker'):
+        worker_main(args.rank, args.world_size, address, authkey, args.epochs, args.batch_size, args.sync_every, args.threads,
+                    args.weights)
+    else:
+        stats = run_local(args.workers, args.epochs, args.batch_size, args.sync_every, address[1], authkey, args.weights)
+        print("samples/s = ",throughput(stats))
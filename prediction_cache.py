@@ -0,0 +1,79 @@
+from __future__ import print_function
+
+'''
+Per-clip prediction cache for eval_network.py
+
+Predictions are stored per checkpoint and settings (crop width, model config), in
+<cache_dir>/<sha1 of checkpoint file + settings>.pkl, keyed by the sha1 of each clip's
+feature file, so only new or changed clips have to go through the model.
+To avoid re-reading every feature file, its hash is reused as long as the file's size and
+mtime are unchanged (<cache_dir>/file_hashes.pkl).
+eval_network.py prunes the predictions of clips that have left the test set before saving, so a
+checkpoint's cache file stays the size of the current test set.
+'''
+import numpy as np
+import hashlib
+import os
+from os.path import isfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def file_hash(path, block_size=1<<20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+def load_pickle(filepath, default):
+    if not isfile(filepath):
+        return default
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
+
+def save_pickle(obj, filepath):   # write-then-rename, so an interrupted run never leaves a broken cache
+    tmp_filepath = filepath + '.' + str(os.getpid()) + '.tmp'    # concurrent runs never share a temp file
+    with open(tmp_filepath, 'wb') as f:
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_filepath, filepath)
+
+
+class PredictionCache(object):
+    def __init__(self, checkpoint_filepath, cache_dir="PredCache/", settings=""):
+        # settings: anything else the predictions depend on (crop width, model config), as a string
+        if not os.path.exists(cache_dir):
+            os.mkdir( cache_dir, 0o755 )
+        self.hashes_filepath = cache_dir + 'file_hashes.pkl'
+        key = hashlib.sha1((file_hash(checkpoint_filepath) + '|' + settings).encode('utf-8')).hexdigest()
+        self.preds_filepath = cache_dir + key + '.pkl'
+        self.file_hashes = load_pickle(self.hashes_filepath, {})   # path -> (size, mtime, sha1)
+        self.preds = load_pickle(self.preds_filepath, {})          # sha1 -> prediction vector
+
+    def feature_hash(self, path):
+        st = os.stat(path)
+        cached = self.file_hashes.get(path)
+        if (cached is not None) and (cached[0:2] == (st.st_size, st.st_mtime)):
+            return cached[2]
+        h = file_hash(path)
+        self.file_hashes[path] = (st.st_size, st.st_mtime, h)
+        return h
+
+    def get(self, h):
+        return self.preds.get(h)
+
+    def put(self, h, pred):
+        self.preds[h] = np.asarray(pred)
+
+    def prune(self, keep):   # drop predictions of clips no longer in the test set (keep: set of feature hashes)
+        self.preds = dict((h, pred) for h, pred in self.preds.items() if h in keep)
+
+    def save(self):
+        save_pickle(self.file_hashes, self.hashes_filepath)
+        save_pickle(self.preds, self.preds_filepath)
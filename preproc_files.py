@@ -0,0 +1,38 @@
+from __future__ import print_function
+
+'''
+Listing and loading the preprocessed clips of a Preproc/ split
+
+Shared by eval_network.py, eval_checkpoints.py, embeddings.py and parallel_train.py.  Files are
+listed in sorted order, so every run and every host sees the same clips in the same order,
+whatever os.listdir returns.  Only numpy is imported here (no keras, librosa or matplotlib),
+so worker processes can use this module before, or without, loading the model code.
+'''
+import numpy as np
+import os
+
+
+def list_split(path, class_names=None):   # paths & class names of every clip in a Preproc/ split
+    if class_names is None:
+        class_names = sorted(os.listdir(path))
+    paths = []
+    labels = []
+    for classname in class_names:
+        for infilename in sorted(os.listdir(path+classname)):
+            paths.append(path + classname + '/' + infilename)
+            labels.append(classname)
+    return paths, labels
+
+def one_hot(labels, class_names):   # (n_clips, n_classes) array, like stacking encode_class in train_network.py
+    Y = np.zeros((len(labels), len(class_names)))
+    for idx, classname in enumerate(labels):
+        Y[idx, class_names.index(classname)] = 1
+    return Y
+
+def load_melgrams(paths, mel_dims, X=None):   # X: optional pre-allocated output, e.g. a memmap
+    if X is None:
+        X = np.zeros((len(paths), mel_dims[1], mel_dims[2], mel_dims[3]))
+    for idx, audio_path in enumerate(paths):
+        melgram = np.load(audio_path)
+        X[idx] = melgram[0,:,:,0:mel_dims[3]]   # just in case files are differnt sizes: clip to first file size
+    return X
@@ -7,6 +7,7 @@ import numpy as np
 import librosa
 import librosa.display
 import os
+import re
 
 def get_class_names(path="Samples/"):  # class names are subdirectory names in Samples/ directory
     class_names = os.listdir(path)
@@ -103,8 +104,198 @@ def preprocess_dataset(inpath="Samples/Samples_Test/", outpath="Preproc/Preproc_
             outfile = outpath3 + classname + '/' + infilename+'.npy'
             np.save(outfile,melgram)
 
+def preprocess_segments(inpath="Samples/Samples_Train/", outpath="Preproc/Preproc_Train/", segment_frames=173, segment_hop=None,
+        n_mels=96, n_fft=2048, hop_length=512, block_frames=256):
+    '''
+    Like preprocess_dataset, but for long recordings: the audio is read in blocks of block_frames
+    STFT frames with librosa.stream, and every segment_frames mel frames (173 ~ 2 s at 44100 Hz,
+    the training clip width) are written out as their own .npy, starting a new segment every
+    segment_hop frames (default: segment_frames, i.e. no overlap).  Memory use depends on the
+    block and segment sizes only, not on the length of the recording.
+    Frames are placed as with center=True (the default of preprocess_dataset), so a 2 s clip
+    still gives 173 frames.  A trailing piece shorter than segment_frames is dropped.
+    '''
+    if segment_hop is None:
+        segment_hop = segment_frames
+    pad = n_fft // 2    # center=True: half a frame of zeros before the first and after the last sample
+    if (pad % hop_length != 0):
+        raise ValueError("preprocess_segments needs n_fft/2 to be a multiple of hop_length")
+
+    if not os.path.exists(outpath):
+        os.mkdir( outpath, 0755 );   # make a new directory for preproc'd files
+
+    class_names = get_class_names(path=inpath)   # get the names of the subdirectories
+    nb_classes = len(class_names)
+    print("class_names = ",class_names)
+    mel_bases = {}    # mel filterbank per sample rate
+    for idx, classname in enumerate(class_names):   # go through the subdirs
+
+        if not os.path.exists(outpath+classname):
+            os.mkdir( outpath+classname, 0755 );   # make a new subdirectory for preproc class
+
+        class_files = os.listdir(inpath+classname)
+        n_files = len(class_files)
+        print(' class name = {:14s} - {:3d}'.format(classname,idx),
+            ", ",n_files," files in this class",sep="")
+
+        for idx2, infilename in enumerate(class_files):
+            audio_path = inpath + classname + '/' + infilename
+            sr = librosa.get_samplerate(audio_path)
+            if sr not in mel_bases:
+                mel_bases[sr] = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+            # center=False frames within each block, so consecutive blocks tile the signal without gaps
+            # or overlap; the padding of center=True is added to the first and last block by hand.
+            # no fill_value: the last block is left short instead of zero-padded past the end padding
+            stream = iter(librosa.stream(audio_path, block_length=block_frames, frame_length=n_fft,
+                                         hop_length=hop_length, mono=True))
+            buf = np.zeros((n_mels, 0))
+            skip = 0      # frames still to drop before the next segment starts
+            n_segments = 0
+            n_frames = 0
+            block = next(stream, None)
+            first = True
+            while block is not None:
+                following = next(stream, None)    # one block of lookahead, to know which block is the last
+                if first:      # pad is a whole number of hops, so the later blocks' frames stay on the same grid
+                    block = np.concatenate((np.zeros(pad, dtype=block.dtype), block))
+                    first = False
+                if following is None:
+                    block = np.concatenate((block, np.zeros(pad, dtype=block.dtype)))
+                if (len(block) < n_fft):
+                    break    # not even one complete frame left
+                S = np.abs(librosa.stft(block, n_fft=n_fft, hop_length=hop_length, center=False))**2
+                n_frames += S.shape[1]
+                buf = np.concatenate((buf, mel_bases[sr].dot(S)), axis=1)
+                drop = min(skip, buf.shape[1])
+                buf = buf[:,drop:]
+                skip -= drop
+                while (buf.shape[1] >= segment_frames):
+                    melgram = librosa.amplitude_to_db(buf[:,0:segment_frames],ref=1.0)[np.newaxis,np.newaxis,:,:]
+                    outfile = outpath + classname + '/' + infilename+'.seg{:05d}.npy'.format(n_segments)
+                    np.save(outfile,melgram)
+                    n_segments += 1
+                    drop = min(segment_hop, buf.shape[1])
+                    buf = buf[:,drop:]
+                    skip = segment_hop - drop
+                block = following
+            print('\r Segmented class: {:14s} ({:2d} of {:2d} classes)'.format(classname,idx+1,nb_classes),
+                   ", file ",idx2+1," of ",n_files,": ",audio_path," -> ",n_segments," segments",sep="")
+            if (0 == n_segments):
+                print("   WARNING: ",audio_path," has only ",n_frames," frames, fewer than segment_frames = ",
+                      segment_frames,": no segments written",sep="")
+
+
+def parse_feature(name):   # "mel128" -> ("mel", 128, 0), "mfcc40_delta2" -> ("mfcc", 40, 2), "spectral_delta" -> ("spectral", 0, 1)
+    m = re.match(r'^(mel|mfcc|spectral)(\d*)(?:_delta(2?))?$', name)
+    if (m is None) or ((m.group(1) == "spectral") != (m.group(2) == "")):
+        raise ValueError("unknown feature '"+name+"' (expected e.g. mel96, mfcc40, mfcc40_delta, mfcc40_delta2, spectral)")
+    delta_order = 0
+    if name.endswith("_delta"):
+        delta_order = 1
+    elif name.endswith("_delta2"):
+        delta_order = 2
+    return (m.group(1), int(m.group(2) or 0), delta_order)
+
+def compute_features(aud, sr, features, n_fft=2048, hop_length=512, mel_bases=None):
+    '''
+    Computes the power STFT once and derives every requested feature from it.
+    Mel spectrograms and MFCCs are shared between the features that need them, e.g. mfcc40 and
+    mfcc40_delta; pass the same mel_bases dict on every call to also reuse the mel filterbanks.
+    Returns {name: 2-D array of shape (rows, frames)}.
+    '''
+    if mel_bases is None:
+        mel_bases = {}
+    S = np.abs(librosa.stft(aud, n_fft=n_fft, hop_length=hop_length))**2
+    mels = {}
+    mfccs = {}
+
+    def mel(n_mels):
+        if n_mels not in mels:
+            if (sr, n_mels) not in mel_bases:
+                mel_bases[(sr, n_mels)] = librosa.filters.mel(sr=sr, n_fft=n_fft, n_mels=n_mels)
+            mels[n_mels] = mel_bases[(sr, n_mels)].dot(S)
+        return mels[n_mels]
+
+    def mfcc(n_mfcc):
+        if n_mfcc not in mfccs:
+            mfccs[n_mfcc] = librosa.feature.mfcc(S=librosa.power_to_db(mel(128)), n_mfcc=n_mfcc)  # librosa's default 128 mel bands
+        return mfccs[n_mfcc]
+
+    out = {}
+    for name in features:
+        kind, n, delta_order = parse_feature(name)
+        if kind == "mel":
+            out[name] = librosa.amplitude_to_db(mel(n),ref=1.0)   # same as preprocess_dataset for n = 96
+        elif kind == "mfcc":
+            out[name] = mfcc(n)
+        else:
+            mag = np.sqrt(S)
+            out[name] = np.vstack([librosa.feature.spectral_centroid(S=mag, sr=sr, n_fft=n_fft),
+                                   librosa.feature.spectral_bandwidth(S=mag, sr=sr, n_fft=n_fft),
+                                   librosa.feature.spectral_rolloff(S=mag, sr=sr, n_fft=n_fft),
+                                   librosa.feature.spectral_flatness(S=mag)])
+        if (delta_order > 0):
+            out[name] = librosa.feature.delta(out[name], order=delta_order)
+    return out
+
+def preprocess_features(inpath="Samples/Samples_Train/", outpath="Preproc/Preproc_Train/", features=["mel96"]):
+    '''
+    Decodes each clip once and writes every feature in features next to each other, in
+    <outpath minus trailing slash>_<feature>/, e.g. Preproc/Preproc_Train_mfcc40/.
+    '''
+    for name in features:
+        parse_feature(name)    # fail before doing any work on a bad name
+    outpaths = dict((name, outpath.rstrip('/')+'_'+name+'/') for name in features)
+    for name in features:
+        if not os.path.exists(outpaths[name]):
+            os.mkdir( outpaths[name], 0755 );   # make a new directory for preproc'd files
+
+    class_names = get_class_names(path=inpath)   # get the names of the subdirectories
+    nb_classes = len(class_names)
+    print("class_names = ",class_names)
+    mel_bases = {}
+    for idx, classname in enumerate(class_names):   # go through the subdirs
+
+        for name in features:
+            if not os.path.exists(outpaths[name]+classname):
+                os.mkdir( outpaths[name]+classname, 0755 );   # make a new subdirectory for preproc class
+
+        class_files = os.listdir(inpath+classname)
+        n_files = len(class_files)
+        print(' class name = {:14s} - {:3d}'.format(classname,idx),
+            ", ",n_files," files in this class",sep="")
+
+        printevery = 20
+        for idx2, infilename in enumerate(class_files):
+            audio_path = inpath + classname + '/' + infilename
+            if (0 == idx2 % printevery):
+                print('\r Loading class: {:14s} ({:2d} of {:2d} classes)'.format(classname,idx+1,nb_classes),
+                       ", file ",idx2+1," of ",n_files,": ",audio_path,sep="")
+            aud, sr = librosa.load(audio_path, sr=None)
+            for name, feature in compute_features(aud, sr, features, mel_bases=mel_bases).items():
+                outfile = outpaths[name] + classname + '/' + infilename+'.npy'
+                np.save(outfile,feature[np.newaxis,np.newaxis,:,:])
+
+
 if __name__ == '__main__':
-    preprocess_dataset()
+    import argparse
+    parser = argparse.ArgumentParser(description="Preprocess Samples/ into log-mel spectrograms under Preproc/")
+    parser.add_argument('--segment', action='store_true', help='stream long recordings and cut them into fixed-length segments')
+    parser.add_argument('--segment_frames', type=int, default=173, help='frames per segment (the training clip width)')
+    parser.add_argument('--segment_hop', type=int, default=None, help='frames between segment starts (< segment_frames overlaps)')
+    parser.add_argument('--features', default=None, help='comma-separated features from one STFT pass, e.g. mel96,mel128,mfcc40,mfcc40_delta,spectral')
+    args = parser.parse_args()
+
+    if (args.segment):
+        for split in ["Test", "Train", "Validation"]:
+            preprocess_segments(inpath="Samples/Samples_"+split+"/", outpath="Preproc/Preproc_"+split+"/",
+                                segment_frames=args.segment_frames, segment_hop=args.segment_hop)
+    elif (args.features):
+        for split in ["Test", "Train", "Validation"]:
+            preprocess_features(inpath="Samples/Samples_"+split+"/", outpath="Preproc/Preproc_"+split+"/",
+                                features=args.features.split(','))
+    else:
+        preprocess_dataset()
 
 
 
@@ -32,6 +32,9 @@ from keras.utils import np_utils
 import os
 from os.path import isfile
 from sklearn.cluster import KMeans
+from model_builder import build_model
+from training_state import TrainingStateCheckpoint
+from batch_autotune import load_batch_size
 from keras.utils import plot_model
 
 from timeit import default_timer as timer
@@ -218,41 +221,6 @@ def build_datasets(train_percentage=0.8, preproc=False):
 
 
 
-def build_model(X,Y,nb_classes):
-
-    nb_filters = 32  # number of convolutional filters to use
-    pool_size = (2, 2)  # size of pooling area for max pooling
-    kernel_size = (3, 3)  # convolution kernel size
-    nb_layers = 4
-    input_shape = (1, X.shape[2], X.shape[3])
-    print("X.shape[2]")
-    print(X.shape[2])
-    print("X.shape[3]")
-    print(X.shape[3])
-
-
-    model = Sequential()
-    model.add(Convolution2D(nb_filters, (kernel_size[0], kernel_size[1]),
-                        border_mode='valid', input_shape=input_shape, data_format='channels_first'))
-    model.add(BatchNormalization(axis=1))
-    model.add(Activation('relu'))
-
-    for layer in range(nb_layers-1):
-        model.add(Convolution2D(nb_filters, kernel_size[0], kernel_size[1]))
-        model.add(BatchNormalization(axis=1))
-        model.add(ELU(alpha=1.0))  
-        model.add(MaxPooling2D(pool_size=pool_size))
-        model.add(Dropout(0.25))
-
-    model.add(Flatten())
-    model.add(Dense(128))
-    model.add(Activation('relu'))
-    model.add(Dropout(0.5))
-    model.add(Dense(nb_classes))
-    model.add(Activation("softmax"))
-    
-    return model
-
 if __name__ == '__main__':
     i = 1
     validation_result = []
@@ -288,15 +256,24 @@ if __name__ == '__main__':
 
 
 	    # train and score the model
-	    batch_size = 10
+	    batch_size = load_batch_size('train', X_train.shape[1:], default=10)   # see batch_autotune.py
 	    nb_epoch = 100
 
 	    #early stopping
 	    
 	    early_stopping = EarlyStopping(monitor='val_acc', patience=15, verbose=2, mode='max')
             time_callback = TimeHistory()
+
+	    # full training state (epoch, optimizer, callbacks, RNG) for resuming after preemption
+	    state_filepath = 'train_state'+str(i)+'.pkl'
+	    state_checkpointer = TrainingStateCheckpoint(state_filepath, period=1,
+		  tracked_callbacks=[checkpointer, time_callback, early_stopping])
 	    hist=model.fit(X_train, Y_train, batch_size=batch_size, nb_epoch=nb_epoch,
-		  verbose=1, validation_data=(X_test, Y_test), callbacks=[checkpointer, time_callback, early_stopping])
+		  verbose=1, validation_data=(X_test, Y_test), initial_epoch=state_checkpointer.initial_epoch,
+		  callbacks=[checkpointer, time_callback, early_stopping, state_checkpointer])
+	    hist.history = state_checkpointer.history    # includes the epochs from before a resume
+	    if ( isfile(state_filepath) ):
+		os.remove(state_filepath)    # run finished; next run starts from scratch
 
 	    score = model.evaluate(X_test, Y_test, verbose = 0)
 	    
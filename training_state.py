@@ -0,0 +1,127 @@
+from __future__ import print_function
+
+'''
+Full training-state checkpointing, so preempted training runs can resume where they stopped
+
+ModelCheckpoint(save_best_only=True) only keeps the best weights.  TrainingStateCheckpoint
+also saves the epoch count, optimizer (e.g. Adadelta accumulator) state, the EarlyStopping /
+ModelCheckpoint bookkeeping, the numpy & python RNG states and the history so far.
+The backend's own RNG (e.g. the one TensorFlow draws dropout masks from) is not saved, so a
+resumed run continues the same training but is not bit-for-bit identical to an uninterrupted one.
+
+The state is snapshotted on the training thread (just copies of numpy arrays) and written
+by a background thread to a temporary file that is then renamed over the previous
+checkpoint, so the training loop doesn't wait on the disk and a kill mid-write never leaves
+a corrupt checkpoint behind.
+'''
+import numpy as np
+import random
+import copy
+import threading
+import os
+from os.path import isfile
+import keras
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+def save_state_atomic(state, filepath):
+    tmp_filepath = filepath + '.tmp'
+    with open(tmp_filepath, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_filepath, filepath)   # atomic on POSIX: readers see the old or the new file, never half of one
+
+def load_state(filepath):
+    if not isfile(filepath):
+        return None
+    with open(filepath, 'rb') as f:
+        return pickle.load(f)
+
+
+class TrainingStateCheckpoint(keras.callbacks.Callback):
+    '''
+    Put this *after* the callbacks it tracks in the callbacks list: on resume it restores their
+    state in on_train_begin, which has to run after their own on_train_begin resets it.
+    Pass initial_epoch=<this callback>.initial_epoch to model.fit so the epoch count continues too.
+    '''
+    # attributes that make up the state of each supported callback type, by class name
+    tracked_attrs = {'EarlyStopping': ['wait', 'best', 'stopped_epoch'],
+                     'ModelCheckpoint': ['best', 'epochs_since_last_save'],
+                     'TimeHistory': ['times']}
+
+    def __init__(self, filepath, period=1, tracked_callbacks=[], resume=True):
+        super(TrainingStateCheckpoint, self).__init__()
+        self.filepath = filepath
+        self.period = period
+        for cb in tracked_callbacks:
+            if type(cb).__name__ not in self.tracked_attrs:
+                raise ValueError("TrainingStateCheckpoint can't track a "+type(cb).__name__+
+                                 " (supported: "+", ".join(sorted(self.tracked_attrs))+")")
+        self.tracked_callbacks = tracked_callbacks
+        self.state = load_state(filepath) if resume else None    # read once, restored in on_train_begin
+        self.initial_epoch = 0 if self.state is None else self.state['epoch'] + 1   # for model.fit(initial_epoch=...)
+        self.history = {}
+        self.queue = queue.Queue(maxsize=1)
+        self.writer = None
+
+    def on_train_begin(self, logs={}):
+        self.writer = threading.Thread(target=self._write_loop)
+        self.writer.daemon = True    # fit doesn't call on_train_end when it raises; don't let the writer block exit
+        state, self.state = self.state, None
+        if state is None:
+            self.writer.start()
+            return
+        print('Training state file detected. Resuming after epoch',state['epoch']+1)
+        self.model.set_weights(state['model_weights'])
+        self.model._make_train_function()    # creates the optimizer's weights so they can be set
+        self.model.optimizer.set_weights(state['optimizer_weights'])
+        for cb, (cb_type, cb_state) in zip(self.tracked_callbacks, state['callbacks']):
+            if (cb_type != type(cb).__name__):
+                raise ValueError("Training state in "+self.filepath+" has a "+cb_type+" where the callbacks list has a "+
+                                 type(cb).__name__+"; pass the same tracked_callbacks as the interrupted run")
+            for attr, value in cb_state.items():
+                setattr(cb, attr, value)
+        np.random.set_state(state['np_random'])
+        random.setstate(state['py_random'])
+        self.history = state['history']
+        self.writer.start()
+
+    def on_epoch_end(self, epoch, logs={}):
+        for k, v in logs.items():
+            self.history.setdefault(k, []).append(v)
+        if (0 != (epoch+1) % self.period) and not self.model.stop_training:
+            return
+        state = {'epoch': epoch,
+                 'model_weights': self.model.get_weights(),
+                 'optimizer_weights': self.model.optimizer.get_weights(),
+                 'callbacks': [(type(cb).__name__, dict((attr, copy.deepcopy(getattr(cb, attr)))
+                                                        for attr in self.tracked_attrs[type(cb).__name__]))
+                               for cb in self.tracked_callbacks],    # copies: the writer thread pickles them later
+                 'np_random': np.random.get_state(),
+                 'py_random': random.getstate(),
+                 'history': dict((k, list(v)) for k, v in self.history.items())}
+        self.queue.put(state)    # blocks only if the previous snapshot is still being written
+
+    def on_train_end(self, logs={}):   # waits for the last snapshot to be written
+        self.queue.put(None)
+        self.writer.join()
+
+    def _write_loop(self):
+        while True:
+            state = self.queue.get()
+            if state is None:
+                return
+            try:
+                save_state_atomic(state, self.filepath)
+            except (IOError, OSError) as e:
+                print('TrainingStateCheckpoint: could not write',self.filepath,':',e)